@@ -10,10 +10,11 @@ from modelscope import BitsAndBytesConfig, GenerationConfig
 from transformers import PreTrainedModel
 
 from swift.tuners import Swift
-from swift.utils import (get_logger, print_model_info, seed_everything,
-                         show_layers)
-from .utils import (InferArguments, Template, get_dataset, get_model_tokenizer,
-                    get_template, inference, save_result_to_jsonl)
+from swift.utils import (get_logger, print_model_info, read_from_json,
+                         seed_everything, show_layers)
+from .utils import (InferArguments, Template, compile_model, get_dataset,
+                    get_model_tokenizer, get_template, inference,
+                    save_result_to_jsonl)
 
 logger = get_logger()
 
@@ -61,8 +62,7 @@ def merge_lora(args: InferArguments, replace_if_exists=False) -> str:
         new_configuration_path = os.path.join(args.ckpt_dir,
                                               configuration_fname)
         if os.path.exists(old_configuration_path):
-            with open(old_configuration_path, 'r') as f:
-                res = json.load(f)
+            res = read_from_json(old_configuration_path)
             res.pop('adapter_cfg', None)
             with open(new_configuration_path, 'w') as f:
                 json.dump(res, f, ensure_ascii=False, indent=4)
@@ -71,8 +71,7 @@ def merge_lora(args: InferArguments, replace_if_exists=False) -> str:
         old_sft_args_path = os.path.join(old_ckpt_dir, sft_args_fname)
         new_sft_args_path = os.path.join(args.ckpt_dir, sft_args_fname)
         if os.path.exists(old_sft_args_path):
-            with open(old_sft_args_path, 'r') as f:
-                res = json.load(f)
+            res = read_from_json(old_sft_args_path)
             res['sft_type'] = 'full'
             with open(new_sft_args_path, 'w') as f:
                 json.dump(res, f, ensure_ascii=False, indent=2)
@@ -117,6 +116,8 @@ def prepare_model_template(
     if args.sft_type == 'lora' and args.ckpt_dir is not None:
         model = Swift.from_pretrained(
             model, args.ckpt_dir, inference_mode=True)
+    if args.compile_model:
+        compile_model(model, args.compile_mode)
 
     print_model_info(model)
     show_layers(model)
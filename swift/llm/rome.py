@@ -1,14 +1,16 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
-import json
+from itertools import islice
+
 import torch
 from modelscope import GenerationConfig
 
 from swift.tuners import Swift
-from swift.utils import (get_logger, print_model_info, seed_everything,
-                         show_layers)
+from swift.utils import (get_logger, print_model_info, read_from_json,
+                         seed_everything, show_layers)
 from ..tuners.rome import RomeConfig
-from .utils import (RomeArguments, Template, get_dataset, get_model_tokenizer,
-                    get_template, inference)
+from .utils import (MODEL_MAPPING, RomeArguments, Template, batch_inference,
+                    compile_model, get_dataset, get_model_tokenizer,
+                    get_prefix_cache, get_template, inference)
 
 logger = get_logger()
 
@@ -21,35 +23,32 @@ def rome_infer(args: RomeArguments) -> None:
     logger.info(f'device_count: {torch.cuda.device_count()}')
     seed_everything(args.seed)
 
+    rome_meta = MODEL_MAPPING[args.model_type].get('rome_meta')
+    if rome_meta is None:
+        raise ValueError(
+            f'model_type: {args.model_type} is not supported by rome.')
+    if args.batch_size > 1 and not rome_meta['batch_first']:
+        # The left padding would shift the position_ids, which are not derived from the attention_mask.
+        raise ValueError(
+            f'model_type: {args.model_type} does not support batch_size > 1.')
+
     # Loading Model and Tokenizer
     model_kwargs = {'low_cpu_mem_usage': True, 'device_map': 'auto'}
     kwargs = {'use_flash_attn': args.use_flash_attn}
     model, tokenizer = get_model_tokenizer(args.model_type, args.torch_dtype,
                                            model_kwargs, **kwargs)
 
-    with open(args.rome_request_file, 'r') as f:
-        request = json.load(f)
-
-    rome_type: str = None
-    if args.model_type in ('llama2-13b-chat', 'llama2-13b', 'llama-13b-chat',
-                           'llama-13b'):
-        rome_type = 'llama-13b'
-        batch_first = True
-    elif args.model_type in ('llama2-7b-chat', 'llama2-7b', 'llama-7b-chat',
-                             'llama-7b'):
-        rome_type = 'llama-7b'
-        batch_first = True
-    elif 'chatglm' in args.model_type and '6b' in args.model_type:
-        rome_type = 'chatglm-6b'
-        batch_first = False
+    request = read_from_json(args.rome_request_file)
 
     config = RomeConfig(
-        model_type=rome_type,
+        model_type=rome_meta['rome_type'],
         knowledge=request,
         tokenizer=tokenizer,
-        batch_first=batch_first,
+        batch_first=rome_meta['batch_first'],
     )
     model = Swift.prepare_model(model, config, inference_mode=True)
+    if args.compile_model:
+        compile_model(model, args.compile_mode)
 
     show_layers(model)
     print_model_info(model)
@@ -79,18 +78,54 @@ def rome_infer(args: RomeArguments) -> None:
     else:
         _, val_dataset = get_dataset(args.dataset, args.dataset_test_ratio,
                                      args.dataset_seed)
-        mini_val_dataset = val_dataset.select(
-            range(min(args.val_dataset_sample, val_dataset.shape[0])))
-        for data in mini_val_dataset:
-            inference(
-                model,
-                template,
-                data.get('query'),
-                data.get('history'),
-                data.get('system'),
-                stream=args.stream,
-                verbose=True)
-            print()
-            print(f"[LABELS]{data.get('response')}")
-            print('-' * 80)
-            # input('next[ENTER]')
+        val_dataset_sample = val_dataset.shape[0]
+        if args.val_dataset_sample >= 0:
+            val_dataset_sample = min(args.val_dataset_sample,
+                                     val_dataset_sample)
+        # Take the first rows with `islice` instead of `select`, which would create an indices mapping.
+        data_list = list(islice(val_dataset, val_dataset_sample))
+        # Encode all the samples in one pass before generating.
+        input_ids_list = [
+            template.encode({
+                'query': data.get('query'),
+                'history': data.get('history'),
+                'system': data.get('system')
+            })['input_ids'] for data in data_list
+        ]
+        if args.batch_size == 1:
+            prefix_cache = None
+            if args.cache_system_prefix:
+                prefix_cache = get_prefix_cache(model, input_ids_list)
+            for data, input_ids in zip(data_list, input_ids_list):
+                inference(
+                    model,
+                    template,
+                    data.get('query'),
+                    data.get('history'),
+                    data.get('system'),
+                    stream=args.stream,
+                    verbose=True,
+                    prefix_cache=prefix_cache,
+                    input_ids=input_ids)
+                print()
+                print(f"[LABELS]{data.get('response')}")
+                print('-' * 80)
+                # input('next[ENTER]')
+        else:
+            for i in range(0, len(data_list), args.batch_size):
+                batch = data_list[i:i + args.batch_size]
+                batch_input_ids = input_ids_list[i:i + args.batch_size]
+                res = batch_inference(
+                    model,
+                    template,
+                    batch,
+                    batch_input_ids,
+                    return_generate_ids=True)
+                # The same output format as `inference(..., verbose=True)`.
+                for data, input_ids, (_, _, generate_ids) in zip(
+                        batch, batch_input_ids, res):
+                    print(f'[PROMPT]{tokenizer.decode(input_ids, False)}'
+                          f'[OUTPUT]{tokenizer.decode(generate_ids, False)}')
+                    print()
+                    print(f"[LABELS]{data.get('response')}")
+                    print('-' * 80)
@@ -25,6 +25,7 @@ logger = get_logger()
 
 
 def llm_sft(args: SftArguments) -> str:
+    args.ensure_distributed_initialized()
     logger.info(f'args: {args}')
     print(f'device_count: {torch.cuda.device_count()}')
     rank, local_rank, world_size, local_world_size = get_dist_setting()
@@ -148,9 +149,11 @@ def llm_sft(args: SftArguments) -> str:
     template: Template = get_template(args.template_type, tokenizer,
                                       args.system, args.max_length,
                                       args.truncation_strategy)
-    train_dataset = dataset_map(train_dataset, template.encode)
+    train_dataset = dataset_map(train_dataset, template.encode,
+                                args.preprocess_num_proc)
     if val_dataset is not None:
-        val_dataset = dataset_map(val_dataset, template.encode)
+        val_dataset = dataset_map(val_dataset, template.encode,
+                                  args.preprocess_num_proc)
     if args.test_oom_error:
         train_dataset = sort_by_max_length(train_dataset, 20000)
     # Data analysis
@@ -259,12 +262,17 @@ def llm_sft(args: SftArguments) -> str:
         **trainer_kwargs)
     trainer.sft_args = args
     if is_master():
-        for args_obj, fname in zip([args, training_args],
-                                   ['sft_args.json', 'training_args.json']):
+        # The private attributes of SftArguments (e.g. `_paths_normalized`) are internal state.
+        sft_args_dict = {
+            k: v
+            for k, v in args.__dict__.items() if not k.startswith('_')
+        }
+        for args_dict, fname in zip([sft_args_dict, training_args.__dict__],
+                                    ['sft_args.json', 'training_args.json']):
             fpath = os.path.join(args.output_dir, fname)
             with open(fpath, 'w') as f:
                 json.dump(
-                    check_json_format(args_obj.__dict__),
+                    check_json_format(args_dict),
                     f,
                     ensure_ascii=False,
                     indent=2)
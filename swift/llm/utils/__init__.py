@@ -13,7 +13,8 @@ from .preprocess import (AlpacaPreprocessor, ClsPreprocessor,
                          TextGenerationPreprocessor)
 from .template import (DEFAULT_SYSTEM, TEMPLATE_MAPPING, History, Prompt,
                        Template, TemplateType, get_template, register_template)
-from .utils import (data_collate_fn, dataset_map, download_dataset,
-                    find_all_linear_for_lora, get_main, inference,
-                    inference_stream, limit_history_length, print_example,
-                    save_result_to_jsonl, sort_by_max_length, stat_dataset)
+from .utils import (batch_inference, compile_model, data_collate_fn,
+                    dataset_map, download_dataset, find_all_linear_for_lora,
+                    get_main, get_prefix_cache, inference, inference_stream,
+                    limit_history_length, print_example, save_result_to_jsonl,
+                    sort_by_max_length, stat_dataset)
@@ -1,9 +1,10 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import List, Optional, Set, Tuple, Union
+from functools import cached_property, lru_cache
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple, Union
 
-import json
 import torch
 import torch.distributed as dist
 from torch import dtype as Dtype
@@ -11,8 +12,8 @@ from transformers.utils.versions import require_version
 
 from swift import get_logger
 from swift.hub import HubApi, ModelScopeConfig
-from swift.utils import (add_version_to_work_dir, broadcast_string,
-                         get_dist_setting, is_dist, is_master)
+from swift.utils import (LazyHelp, add_version_to_work_dir, broadcast_string,
+                         get_dist_setting, is_dist, is_master, read_from_json)
 from .dataset import (DATASET_MAPPING, DatasetName, get_custom_dataset,
                       register_dataset)
 from .model import (MODEL_MAPPING, ModelType, dtype_mapping,
@@ -21,13 +22,23 @@ from .template import TEMPLATE_MAPPING, TemplateType
 
 logger = get_logger()
 
+# The choices are only listed when `--help` is formatted.
+_model_type_help = LazyHelp(
+    'model_type choices: `MODEL_MAPPING.keys()`',
+    lambda: f'model_type choices: {list(MODEL_MAPPING.keys())}')
+_template_type_help = LazyHelp(
+    "template_type choices: `TEMPLATE_MAPPING.keys()` and 'AUTO'", lambda:
+    f"template_type choices: {list(TEMPLATE_MAPPING.keys()) + ['AUTO']}")
+_dataset_help = LazyHelp(
+    'dataset choices: `DATASET_MAPPING.keys()`',
+    lambda: f'dataset choices: {list(DATASET_MAPPING.keys())}')
+
 
 @dataclass
 class SftArguments:
     # You can specify the model by either using the model_type or model_id_or_path.
     model_type: Optional[str] = field(
-        default=None,
-        metadata={'help': f'model_type choices: {list(MODEL_MAPPING.keys())}'})
+        default=None, metadata={'help': _model_type_help})
     model_id_or_path: Optional[str] = None
     model_revision: Optional[str] = None
     model_cache_dir: Optional[str] = None
@@ -38,15 +49,18 @@ class SftArguments:
     tuner_backend: str = field(
         default='swift', metadata={'choices': ['swift', 'peft']})
     template_type: str = field(
-        default='AUTO',
-        metadata={
-            'help':
-            f"template_type choices: {list(TEMPLATE_MAPPING.keys()) + ['AUTO']}"
-        })
+        default='AUTO', metadata={'help': _template_type_help})
     output_dir: str = 'output'
     add_output_dir_suffix: bool = True
     ddp_backend: str = field(
         default='nccl', metadata={'choices': ['nccl', 'gloo', 'mpi', 'ccl']})
+    lazy_init_dist: bool = field(
+        default=True,
+        metadata={
+            'help':
+            'If set to True, `torch.cuda.set_device` and `dist.init_process_group` are deferred '
+            'until `ensure_distributed_initialized` is called by the training entrypoint.'
+        })
 
     seed: int = 42
     resume_from_checkpoint: Optional[str] = None
@@ -54,8 +68,7 @@ class SftArguments:
         default='AUTO', metadata={'choices': ['bf16', 'fp16', 'fp32', 'AUTO']})
 
     dataset: Optional[List[str]] = field(
-        default=None,
-        metadata={'help': f'dataset choices: {list(DATASET_MAPPING.keys())}'})
+        default=None, metadata={'help': _dataset_help})
     dataset_seed: int = 42
     dataset_test_ratio: float = 0.01
     train_dataset_sample: int = 20000  # -1: all dataset
@@ -110,6 +123,7 @@ class SftArguments:
     save_total_limit: int = 2  # save last and best. -1: all checkpoints
     logging_steps: int = 5
     dataloader_num_workers: int = 1
+    preprocess_num_proc: int = 1
 
     push_to_hub: bool = False
     # 'user_name/repo_name' or 'repo_name'
@@ -163,19 +177,13 @@ class SftArguments:
                 self.output_dir = add_version_to_work_dir(self.output_dir)
                 logger.info(f'output_dir: {self.output_dir}')
 
-        self.torch_dtype, self.fp16, self.bf16 = select_dtype(self)
+        select_dtype(self)
+        self._dist_initialized = False
         if is_dist():
-            rank, local_rank, _, _ = get_dist_setting()
-            torch.cuda.set_device(local_rank)
-            self.seed += rank  # Avoid the same dropout
             if self.ddp_backend == 'gloo' and self.quantization_bit != 0:
                 raise ValueError('not supported, please use `nccl`')
-
-            # Initialize in advance
-            if not dist.is_initialized():
-                dist.init_process_group(backend=self.ddp_backend)
-            # Make sure to set the same output_dir when using DDP.
-            self.output_dir = broadcast_string(self.output_dir)
+            if not self.lazy_init_dist or dist.is_initialized():
+                self.ensure_distributed_initialized()
 
         if self.sft_type in ('lora', 'longlora', 'qalora'):
             if self.learning_rate is None:
@@ -228,21 +236,47 @@ class SftArguments:
         self.deepspeed = None
         if self.deepspeed_config_path is not None:
             require_version('deepspeed')
-            with open(self.deepspeed_config_path, 'r') as f:
-                self.deepspeed = json.load(f)
+            self.deepspeed = read_from_json(self.deepspeed_config_path)
             logger.info(f'Using deepspeed: {self.deepspeed}')
         if self.logging_dir is None:
             self.logging_dir = f'{self.output_dir}/runs'
         if self.report_to is None:
             self.report_to == ['all']
 
+    @cached_property
+    def torch_dtype(self) -> Dtype:
+        return _resolve_torch_dtype(self.dtype, self.sft_type == 'full')[0]
+
+    @cached_property
+    def fp16(self) -> bool:
+        return _resolve_torch_dtype(self.dtype, self.sft_type == 'full')[1]
+
+    @cached_property
+    def bf16(self) -> bool:
+        return _resolve_torch_dtype(self.dtype, self.sft_type == 'full')[2]
+
+    def ensure_distributed_initialized(self) -> None:
+        if not is_dist() or self._dist_initialized:
+            return
+        rank, local_rank, _, _ = get_dist_setting()
+        torch.cuda.set_device(local_rank)
+        self.seed += rank  # Avoid the same dropout
+        # Initialize in advance
+        if not dist.is_initialized():
+            dist.init_process_group(backend=self.ddp_backend)
+        # Make sure to set the same output_dir when using DDP.
+        output_dir = self.output_dir
+        self.output_dir = broadcast_string(output_dir)
+        if self.logging_dir == f'{output_dir}/runs':
+            self.logging_dir = f'{self.output_dir}/runs'
+        self._dist_initialized = True
+
 
 @dataclass
 class InferArguments:
     # You can specify the model by either using the model_type or model_id_or_path.
     model_type: Optional[str] = field(
-        default=None,
-        metadata={'help': f'model_type choices: {list(MODEL_MAPPING.keys())}'})
+        default=None, metadata={'help': _model_type_help})
     model_id_or_path: Optional[str] = None
     model_revision: Optional[str] = None
     model_cache_dir: Optional[str] = None
@@ -251,11 +285,7 @@ class InferArguments:
         default='lora',
         metadata={'choices': ['lora', 'longlora', 'qalora', 'full']})
     template_type: str = field(
-        default='AUTO',
-        metadata={
-            'help':
-            f"template_type choices: {list(TEMPLATE_MAPPING.keys()) + ['AUTO']}"
-        })
+        default='AUTO', metadata={'help': _template_type_help})
     ckpt_dir: Optional[str] = field(
         default=None, metadata={'help': '/path/to/your/vx_xxx/checkpoint-xxx'})
     load_args_from_ckpt_dir: bool = True
@@ -266,8 +296,7 @@ class InferArguments:
         default='AUTO', metadata={'choices': ['bf16', 'fp16', 'fp32', 'AUTO']})
 
     dataset: Optional[List[str]] = field(
-        default=None,
-        metadata={'help': f'dataset choices: {list(DATASET_MAPPING.keys())}'})
+        default=None, metadata={'help': _dataset_help})
     dataset_seed: int = 42
     dataset_test_ratio: float = 0.01
     val_dataset_sample: int = 10  # -1: all dataset
@@ -303,6 +332,10 @@ class InferArguments:
     stream: bool = True
     merge_lora_and_save: bool = False
     overwrite_generation_config: bool = False
+    compile_model: bool = False
+    compile_mode: str = field(
+        default='reduce-overhead',
+        metadata={'choices': ['default', 'reduce-overhead', 'max-autotune']})
     # compatibility
     show_dataset_sample: int = 10
 
@@ -322,7 +355,7 @@ class InferArguments:
         register_custom_dataset(self)
         check_flash_attn(self)
 
-        self.torch_dtype, _, _ = select_dtype(self)
+        select_dtype(self)
         if self.template_type == 'AUTO':
             self.template_type = get_default_template_type(self.model_type)
             logger.info(f'Setting template_type: {self.template_type}')
@@ -339,6 +372,10 @@ class InferArguments:
             self.overwrite_generation_config = False
             logger.warning('Setting overwrite_generation_config: False')
 
+    @cached_property
+    def torch_dtype(self) -> Dtype:
+        return _resolve_torch_dtype(self.dtype, False)[0]
+
 
 @dataclass
 class RomeArguments(InferArguments):
@@ -349,6 +386,22 @@ class RomeArguments(InferArguments):
             'The rome request file, please check the documentation '
             'to get the format'
         })
+    batch_size: int = field(
+        default=1,
+        metadata={
+            'help':
+            'The batch size used when evaluating the val_dataset, '
+            'if greater than 1, the samples are generated in batches without streaming '
+            '(not supported by the chatglm models)'
+        })
+    cache_system_prefix: bool = field(
+        default=False,
+        metadata={
+            'help':
+            'Prefill the common prefix of the val_dataset samples (e.g. the system part) once '
+            'and reuse its kv-cache, only takes effect when batch_size is 1. '
+            'Not supported by the chatglm models'
+        })
 
     def __post_init__(self) -> None:
         handle_compatibility(self)
@@ -356,48 +409,65 @@ class RomeArguments(InferArguments):
         set_model_type(self)
         check_flash_attn(self)
 
-        self.torch_dtype, _, _ = select_dtype(self)
+        select_dtype(self)
         if self.template_type == 'AUTO':
             self.template_type = get_default_template_type(self.model_type)
             logger.info(f'Setting template_type: {self.template_type}')
 
         if self.max_length == -1:
             self.max_length = None
+        if self.batch_size <= 0:
+            raise ValueError(
+                f'batch_size: {self.batch_size}, please use a positive integer.'
+            )
 
 
 dtype_mapping_reversed = {v: k for k, v in dtype_mapping.items()}
 
 
-def select_dtype(
-        args: Union[SftArguments, InferArguments]) -> Tuple[Dtype, bool, bool]:
-    if args.dtype == 'AUTO' and not torch.cuda.is_bf16_supported():
-        args.dtype = 'fp16'
-    if args.dtype == 'AUTO' and ('int4' in args.model_type
-                                 or 'int8' in args.model_type):
-        model_torch_dtype = MODEL_MAPPING[args.model_type]['torch_dtype']
-        if model_torch_dtype is not None:
-            args.dtype = dtype_mapping[model_torch_dtype]
-    if args.dtype == 'AUTO':
-        args.dtype = 'bf16'
+@lru_cache(maxsize=1)
+def _bf16_supported() -> bool:
+    return torch.cuda.is_available() and torch.cuda.is_bf16_supported()
 
-    torch_dtype = dtype_mapping_reversed[args.dtype]
+
+@lru_cache()
+def _resolve_torch_dtype(dtype: str,
+                         is_full_sft: bool) -> Tuple[Dtype, bool, bool]:
+    torch_dtype = dtype_mapping_reversed[dtype]
 
     assert torch_dtype in {torch.float16, torch.bfloat16, torch.float32}
     if torch_dtype == torch.float16:
-        if isinstance(args, SftArguments) and args.sft_type == 'full':
+        if is_full_sft:
             torch_dtype = torch.float32
-            logger.warning('Setting torch_dtype: torch.float32')
         fp16, bf16 = True, False
     elif torch_dtype == torch.bfloat16:
-        support_bf16 = torch.cuda.is_bf16_supported()
-        if not support_bf16:
-            logger.warning(f'support_bf16: {support_bf16}')
         fp16, bf16 = False, True
     else:
         fp16, bf16 = False, False
     return torch_dtype, fp16, bf16
 
 
+def select_dtype(args: Union[SftArguments, InferArguments]) -> None:
+    if args.dtype == 'AUTO' and not _bf16_supported():
+        args.dtype = 'fp16'
+    if args.dtype == 'AUTO' and ('int4' in args.model_type
+                                 or 'int8' in args.model_type):
+        model_torch_dtype = MODEL_MAPPING[args.model_type]['torch_dtype']
+        if model_torch_dtype is not None:
+            args.dtype = dtype_mapping[model_torch_dtype]
+    if args.dtype == 'AUTO':
+        args.dtype = 'bf16'
+    # `_resolve_torch_dtype` is cached, the warnings are emitted here for every arguments object.
+    is_full_sft = isinstance(args, SftArguments) and args.sft_type == 'full'
+    torch_dtype, _, bf16 = _resolve_torch_dtype(args.dtype, is_full_sft)
+    if torch_dtype != dtype_mapping_reversed[args.dtype]:
+        logger.warning(f'Setting torch_dtype: {torch_dtype}')
+    if bf16:
+        support_bf16 = _bf16_supported()
+        if not support_bf16:
+            logger.warning(f'support_bf16: {support_bf16}')
+
+
 def select_bnb(
         args: Union[SftArguments, InferArguments]) -> Tuple[Dtype, bool, bool]:
     if args.bnb_4bit_comp_dtype == 'AUTO':
@@ -421,6 +491,8 @@ def select_bnb(
 
 
 def handle_compatibility(args: Union[SftArguments, InferArguments]) -> None:
+    if getattr(args, '_compat_handled', False):
+        return
     if args.dataset is not None and len(
             args.dataset) == 1 and ',' in args.dataset[0]:
         args.dataset = args.dataset[0].split(',')
@@ -437,15 +509,40 @@ def handle_compatibility(args: Union[SftArguments, InferArguments]) -> None:
             and args.val_dataset_sample == 10):
         # args.val_dataset_sample is the default value and args.show_dataset_sample is not the default value.
         args.val_dataset_sample = args.show_dataset_sample
+    args._compat_handled = True
 
 
-def set_model_type(args: Union[SftArguments, InferArguments]) -> None:
-    assert args.model_type is None or args.model_id_or_path is None
-    if args.model_id_or_path is not None:
+# (len(MODEL_MAPPING), model_mapping_reversed)
+_model_mapping_reversed_cache: Optional[Tuple[int, Dict[str, str]]] = None
+
+
+def _get_model_mapping_reversed() -> Dict[str, str]:
+    global _model_mapping_reversed_cache
+    # The length check keeps the cache valid after `register_model`.
+    if (_model_mapping_reversed_cache is None
+            or _model_mapping_reversed_cache[0] != len(MODEL_MAPPING)):
         model_mapping_reversed = {
             v['model_id_or_path'].lower(): k
             for k, v in MODEL_MAPPING.items()
         }
+        _model_mapping_reversed_cache = (len(MODEL_MAPPING),
+                                         model_mapping_reversed)
+    return _model_mapping_reversed_cache[1]
+
+
+_verified_model_types: Set[str] = set()
+
+
+@lru_cache()
+def _cached_require_version(requirement: str) -> None:
+    # Only successful checks are cached, a failing check raises every time.
+    require_version(requirement)
+
+
+def set_model_type(args: Union[SftArguments, InferArguments]) -> None:
+    assert args.model_type is None or args.model_id_or_path is None
+    if args.model_id_or_path is not None:
+        model_mapping_reversed = _get_model_mapping_reversed()
         model_id_or_path = args.model_id_or_path
         model_id_or_path_lower = model_id_or_path.lower()
         if model_id_or_path_lower not in model_mapping_reversed:
@@ -466,9 +563,11 @@ def set_model_type(args: Union[SftArguments, InferArguments]) -> None:
     else:
         model_info['revision'] = args.model_revision
     args.model_id_or_path = model_info['model_id_or_path']
-    requires = model_info['requires']
-    for require in requires:
-        require_version(require)
+    if args.model_type not in _verified_model_types:
+        requires = model_info['requires']
+        for require in requires:
+            _cached_require_version(require)
+        _verified_model_types.add(args.model_type)
 
 
 def prepare_push_ms_hub(args: SftArguments) -> None:
@@ -487,43 +586,74 @@ def prepare_push_ms_hub(args: SftArguments) -> None:
         logger.info('hub login successful!')
 
 
-def _check_path(
-        k: str, value: Union[str, List[str]],
-        check_exist_path_set: Optional[Set[str]]) -> Union[str, List[str]]:
-    if isinstance(value, str):
-        value = os.path.expanduser(value)
-        value = os.path.abspath(value)
-        if k in check_exist_path_set and not os.path.exists(value):
-            raise FileNotFoundError(f"`{k}`: '{value}'")
-    elif isinstance(value, list):
-        res = []
-        for v in value:
-            res.append(_check_path(k, v, check_exist_path_set))
-        value = res
-    return value
+_CHECK_EXIST_PATH = ('model_cache_dir', 'ckpt_dir', 'resume_from_checkpoint',
+                     'deepspeed_config_path', 'custom_train_dataset_path',
+                     'custom_val_dataset_path')
+_CHECK_EXIST_PATH_SET = frozenset(_CHECK_EXIST_PATH)
+_OTHER_PATH = ('output_dir', 'logging_dir')
 
 
-def handle_path(args: Union[SftArguments, InferArguments]) -> None:
-    check_exist_path = [
-        'model_cache_dir', 'ckpt_dir', 'resume_from_checkpoint',
-        'deepspeed_config_path', 'custom_train_dataset_path',
-        'custom_val_dataset_path'
+def _check_path(k: str, value: Union[str, List[str]],
+                check_exist_path_set: FrozenSet[str],
+                exists_cache: Dict[str, bool]) -> Union[str, List[str]]:
+    is_list = isinstance(value, list)
+    path_list = value if is_list else [value]
+    res = [
+        os.path.abspath(os.path.expanduser(path))
+        if isinstance(path, str) else path for path in path_list
+    ]
+    if k not in check_exist_path_set:
+        return res if is_list else res[0]
+    # Avoid stating the same path twice.
+    unchecked = list(
+        dict.fromkeys(
+            path for path in res
+            if isinstance(path, str) and path not in exists_cache))
+    if len(unchecked) > 1:
+        # `os.stat` releases the GIL, so the calls overlap (e.g. on network file systems).
+        with ThreadPoolExecutor(
+                max_workers=min(8, len(unchecked))) as executor:
+            exists_cache.update(
+                zip(unchecked, executor.map(os.path.exists, unchecked)))
+    elif len(unchecked) == 1:
+        exists_cache[unchecked[0]] = os.path.exists(unchecked[0])
+    missing = [
+        path for path in res
+        if isinstance(path, str) and not exists_cache[path]
     ]
+    if len(missing) == 1:
+        raise FileNotFoundError(f"`{k}`: '{missing[0]}'")
+    elif len(missing) > 1:
+        raise FileNotFoundError(f'`{k}`: {missing}')
+    return res if is_list else res[0]
+
+
+def handle_path(args: Union[SftArguments, InferArguments]) -> None:
+    if getattr(args, '_paths_normalized', False):
+        return
+    check_exist_path = _CHECK_EXIST_PATH
+    check_exist_path_set = _CHECK_EXIST_PATH_SET
     if args.model_id_or_path is not None and (
             args.model_id_or_path.startswith('~')
             or args.model_id_or_path.startswith('/')):
-        check_exist_path.append('model_id_or_path')
-    check_exist_path_set = set(check_exist_path)
-    other_path = ['output_dir', 'logging_dir']
-    for k in check_exist_path + other_path:
+        check_exist_path += ('model_id_or_path', )
+        check_exist_path_set = check_exist_path_set | {'model_id_or_path'}
+    exists_cache: Dict[str, bool] = {}
+    for k in check_exist_path + _OTHER_PATH:
         value = getattr(args, k, None)
         if value is None:
             continue
-        value = _check_path(k, value, check_exist_path_set)
+        value = _check_path(k, value, check_exist_path_set, exists_cache)
         setattr(args, k, value)
+    args._paths_normalized = True
+
+
+# (custom_train_dataset_path, custom_val_dataset_path) of the registered `_custom_dataset`
+_last_custom_dataset_key: Optional[Tuple[tuple, tuple]] = None
 
 
 def register_custom_dataset(args: Union[SftArguments, InferArguments]) -> None:
+    global _last_custom_dataset_key
     if args.custom_train_dataset_path is None:
         args.custom_train_dataset_path = []
     if args.custom_val_dataset_path is None:
@@ -531,14 +661,20 @@ def register_custom_dataset(args: Union[SftArguments, InferArguments]) -> None:
     if len(args.custom_train_dataset_path) == 0 and len(
             args.custom_val_dataset_path) == 0:
         return
-    if '_custom_dataset' in DATASET_MAPPING:
-        DATASET_MAPPING.pop('_custom_dataset')
-    register_dataset(
-        '_custom_dataset',
-        '_custom_dataset',
-        args.custom_train_dataset_path,
-        args.custom_val_dataset_path,
-        get_function=get_custom_dataset)
+    key = (tuple(args.custom_train_dataset_path),
+           tuple(args.custom_val_dataset_path))
+    # Re-registering would invalidate the handles of the registered dataset.
+    if (key != _last_custom_dataset_key
+            or '_custom_dataset' not in DATASET_MAPPING):
+        if '_custom_dataset' in DATASET_MAPPING:
+            DATASET_MAPPING.pop('_custom_dataset')
+        register_dataset(
+            '_custom_dataset',
+            '_custom_dataset',
+            args.custom_train_dataset_path,
+            args.custom_val_dataset_path,
+            get_function=get_custom_dataset)
+        _last_custom_dataset_key = key
     if args.dataset is None:
         args.dataset = ['_custom_dataset']
     elif '_custom_dataset' not in args.dataset:
@@ -550,8 +686,7 @@ def load_from_ckpt_dir(args: InferArguments) -> None:
     if not os.path.exists(sft_args_path):
         logger.info(f'{sft_args_path} not found')
         return
-    with open(sft_args_path, 'r') as f:
-        sft_args = json.load(f)
+    sft_args = read_from_json(sft_args_path)
     imported_keys = [
         'model_type', 'model_id_or_path', 'model_revision', 'model_cache_dir',
         'sft_type', 'template_type', 'dtype', 'system', 'quantization_bit',
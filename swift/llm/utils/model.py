@@ -432,16 +432,51 @@ def remove_property(tokenizer_cls: Type[PreTrainedTokenizerBase],
             setattr(tokenizer_cls, k, tokenizer_config[k])
 
 
-@register_model(ModelType.chatglm3_6b_32k, 'ZhipuAI/chatglm3-6b-32k',
-                LoRATM.chatglm, TemplateType.chatglm3)
-@register_model(ModelType.chatglm3_6b, 'ZhipuAI/chatglm3-6b', LoRATM.chatglm,
-                TemplateType.chatglm3)
-@register_model(ModelType.chatglm3_6b_base, 'ZhipuAI/chatglm3-6b-base',
-                LoRATM.chatglm, TemplateType.chatglm_generation)
-@register_model(ModelType.chatglm2_6b_32k, 'ZhipuAI/chatglm2-6b-32k',
-                LoRATM.chatglm, TemplateType.chatglm2)
-@register_model(ModelType.chatglm2_6b, 'ZhipuAI/chatglm2-6b', LoRATM.chatglm,
-                TemplateType.chatglm2)
+@register_model(
+    ModelType.chatglm3_6b_32k,
+    'ZhipuAI/chatglm3-6b-32k',
+    LoRATM.chatglm,
+    TemplateType.chatglm3,
+    rome_meta={
+        'rome_type': 'chatglm-6b',
+        'batch_first': False
+    })
+@register_model(
+    ModelType.chatglm3_6b,
+    'ZhipuAI/chatglm3-6b',
+    LoRATM.chatglm,
+    TemplateType.chatglm3,
+    rome_meta={
+        'rome_type': 'chatglm-6b',
+        'batch_first': False
+    })
+@register_model(
+    ModelType.chatglm3_6b_base,
+    'ZhipuAI/chatglm3-6b-base',
+    LoRATM.chatglm,
+    TemplateType.chatglm_generation,
+    rome_meta={
+        'rome_type': 'chatglm-6b',
+        'batch_first': False
+    })
+@register_model(
+    ModelType.chatglm2_6b_32k,
+    'ZhipuAI/chatglm2-6b-32k',
+    LoRATM.chatglm,
+    TemplateType.chatglm2,
+    rome_meta={
+        'rome_type': 'chatglm-6b',
+        'batch_first': False
+    })
+@register_model(
+    ModelType.chatglm2_6b,
+    'ZhipuAI/chatglm2-6b',
+    LoRATM.chatglm,
+    TemplateType.chatglm2,
+    rome_meta={
+        'rome_type': 'chatglm-6b',
+        'batch_first': False
+    })
 def get_model_tokenizer_chatglm(model_dir: str,
                                 torch_dtype: Dtype,
                                 model_kwargs: Dict[str, Any],
@@ -577,14 +612,22 @@ def get_model_tokenizer_yi(model_dir: str,
     LoRATM.llama2,
     TemplateType.default_generation_bos,
     ignore_file_pattern=[r'.+\.bin$'],
-    support_flash_attn=True)
+    support_flash_attn=True,
+    rome_meta={
+        'rome_type': 'llama-7b',
+        'batch_first': True
+    })
 @register_model(
     ModelType.llama2_13b,
     'modelscope/Llama-2-13b-ms',
     LoRATM.llama2,
     TemplateType.default_generation_bos,
     ignore_file_pattern=[r'.+\.bin$'],
-    support_flash_attn=True)
+    support_flash_attn=True,
+    rome_meta={
+        'rome_type': 'llama-13b',
+        'batch_first': True
+    })
 @register_model(
     ModelType.llama2_70b,
     'modelscope/Llama-2-70b-ms',
@@ -598,14 +641,22 @@ def get_model_tokenizer_yi(model_dir: str,
     LoRATM.llama2,
     TemplateType.llama,
     ignore_file_pattern=[r'.+\.bin$'],
-    support_flash_attn=True)
+    support_flash_attn=True,
+    rome_meta={
+        'rome_type': 'llama-7b',
+        'batch_first': True
+    })
 @register_model(
     ModelType.llama2_13b_chat,
     'modelscope/Llama-2-13b-chat-ms',
     LoRATM.llama2,
     TemplateType.llama,
     ignore_file_pattern=[r'.+\.bin$'],
-    support_flash_attn=True)
+    support_flash_attn=True,
+    rome_meta={
+        'rome_type': 'llama-13b',
+        'batch_first': True
+    })
 @register_model(
     ModelType.llama2_70b_chat,
     'modelscope/Llama-2-70b-chat-ms',
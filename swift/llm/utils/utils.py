@@ -1,36 +1,45 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
 # Part of the implementation is borrowed from huggingface/transformers.
-import heapq
+import inspect
 import logging
 import os
 import shutil
-from functools import wraps
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import lru_cache, partial, wraps
 from tempfile import TemporaryDirectory
-from typing import (Any, Callable, Dict, Iterator, List, Optional, Tuple, Type,
-                    TypeVar, Union)
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple, Type, TypeVar, Union)
 
 import accelerate
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import requests
 import torch
 import torch.distributed as dist
-import torch.nn.functional as F
 import transformers
 from accelerate.utils.modeling import (get_balanced_memory,
                                        infer_auto_device_map)
 from datasets import Dataset as HfDataset
+from datasets import Features, Sequence, Value
 from modelscope import MsDataset
 from modelscope.utils.config_ds import MS_CACHE_HOME
 from modelscope.utils.logger import get_logger as get_ms_logger
+from peft import PeftModel
+from requests.adapters import HTTPAdapter
+from torch import Tensor
 from torch import device as Device
 from torch.nn import Linear, Module
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.nn.utils.rnn import pad_sequence
 from tqdm.auto import tqdm
 from transformers import (PreTrainedModel, PreTrainedTokenizerBase,
                           TextStreamer, trainer)
+from transformers.utils.versions import require_version
 
 from swift.hub import ModelScopeConfig
+from swift.tuners import SwiftModel
 from swift.utils import (append_to_jsonl, get_dist_setting, get_logger,
                          is_ddp_plus_mp, is_dist, is_local_master, is_master,
                          parse_args, stat_array, upper_bound)
@@ -42,11 +51,41 @@ ms_logger = get_ms_logger()
 os.environ['TOKENIZERS_PARALLELISM'] = 'true'
 
 
-def download_files(url: str, local_path: str, cookies) -> None:
-    resp = requests.get(url, cookies=cookies, stream=True)
-    with open(local_path, 'wb') as f:
-        for data in tqdm(resp.iter_lines()):
-            f.write(data)
+def download_files(url: str,
+                   local_path: str,
+                   cookies,
+                   session: Optional[requests.Session] = None) -> None:
+    if session is None:
+        session = requests
+    resp = session.get(url, cookies=cookies, stream=True)
+    resp.raise_for_status()
+    total = int(resp.headers.get('Content-Length', 0))
+    # Write the raw bytes in chunks, `iter_lines` would drop the line breaks.
+    with open(local_path, 'wb') as f, tqdm(
+            total=total, unit='B', unit_scale=True) as pbar:
+        for chunk in resp.iter_content(chunk_size=1 << 20):
+            f.write(chunk)
+            pbar.update(len(chunk))
+
+
+@lru_cache(maxsize=1)
+def _load_ms_cookies(mtime: Optional[float]):
+    return ModelScopeConfig.get_cookies()
+
+
+def _get_ms_cookies():
+    # Keyed by the mtime of the cookies file, so that a new login is picked up.
+    cookies_path = os.path.join(ModelScopeConfig.path_credential,
+                                ModelScopeConfig.COOKIES_FILE_NAME)
+    mtime = None
+    if os.path.exists(cookies_path):
+        mtime = os.path.getmtime(cookies_path)
+    cookies = _load_ms_cookies(mtime)
+    if cookies is not None and any(cookie.is_expired() for cookie in cookies):
+        # The cookies expired after being cached, reload them to warn and drop them.
+        _load_ms_cookies.cache_clear()
+        cookies = _load_ms_cookies(mtime)
+    return cookies
 
 
 def download_dataset(model_id: str,
@@ -58,16 +97,36 @@ def download_dataset(model_id: str,
     tmp_dir = os.path.join(cache_dir, 'tmp')
     os.makedirs(local_dir, exist_ok=True)
     os.makedirs(tmp_dir, exist_ok=True)
-    cookies = ModelScopeConfig.get_cookies()
-    with TemporaryDirectory(dir=tmp_dir) as temp_dir:
-        for remote_fpath in files:
-            url = url.format(fpath=remote_fpath)
-            temp_fpath = os.path.join(temp_dir, remote_fpath)
-            local_fpath = os.path.join(local_dir, remote_fpath)
-            if not force_download and os.path.exists(local_fpath):
-                continue
-            download_files(url, temp_fpath, cookies)
-            shutil.copy2(temp_fpath, local_fpath)
+    cookies = _get_ms_cookies()
+    remote_fpaths = [
+        remote_fpath for remote_fpath in files if force_download
+        or not os.path.exists(os.path.join(local_dir, remote_fpath))
+    ]
+    if len(remote_fpaths) == 0:
+        return local_dir
+    # The files are downloaded concurrently, reusing the connections of a session.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def _download(remote_fpath: str, temp_dir: str) -> None:
+        temp_fpath = os.path.join(temp_dir, remote_fpath)
+        local_fpath = os.path.join(local_dir, remote_fpath)
+        os.makedirs(os.path.dirname(temp_fpath), exist_ok=True)
+        os.makedirs(os.path.dirname(local_fpath), exist_ok=True)
+        download_files(
+            url.format(fpath=remote_fpath), temp_fpath, cookies, session)
+        shutil.copy2(temp_fpath, local_fpath)
+
+    with session, TemporaryDirectory(dir=tmp_dir) as temp_dir, \
+            ThreadPoolExecutor(max_workers=min(8, len(remote_fpaths))) as executor:
+        futures = [
+            executor.submit(_download, remote_fpath, temp_dir)
+            for remote_fpath in remote_fpaths
+        ]
+        for future in futures:
+            future.result()
 
     return local_dir
 
@@ -80,11 +139,9 @@ def _msdataset_ddp_load(*args, **kwargs):
     if is_dist() and not is_local_master():
         dist.barrier()
     dataset = _old_msdataset_load(*args, **kwargs)
+    # The local master loads (and caches) first, this barrier releases the other ranks.
     if is_dist() and is_local_master():
         dist.barrier()
-
-    if is_dist():
-        dist.barrier()
     return dataset
 
 
@@ -92,8 +149,16 @@ def _get_max_memory(device_ids: List[int]) -> Dict[Union[int, str], int]:
     """add feat in accelerate to support DDP + MP"""
     import psutil
     # Make sure CUDA is initialized on each GPU to have the right memory info.
-    for i in device_ids:
-        _ = torch.tensor([0], device=i)
+    # The context creation is host-blocking, so the devices are initialized in threads.
+    torch.cuda.init()
+    if len(device_ids) > 1:
+        with ThreadPoolExecutor(max_workers=len(device_ids)) as executor:
+            list(executor.map(lambda i: torch.empty(1, device=i), device_ids))
+    else:
+        for i in device_ids:
+            _ = torch.empty(1, device=i)
+    # Release the cached blocks so that `mem_get_info` reports the real free memory.
+    torch.cuda.empty_cache()
 
     device_ids_set = set(device_ids)
     max_memory = {}
@@ -111,12 +176,10 @@ def _sync_max_memory(
     max_memory_list = [
         v for k, v in max_memory.items() if (v > 0 and k != 'cpu')
     ]
-    _, local_rank, world_size, _ = get_dist_setting()
-    src_tensor = torch.tensor(max_memory_list).to(local_rank)
-    tgt_tensor_list = [torch.zeros_like(src_tensor) for _ in range(world_size)]
-    dist.all_gather(tgt_tensor_list, src_tensor)
-    tgt_tensor = torch.stack(tgt_tensor_list, dim=0)
-    new_max_memory_iter = iter(tgt_tensor.min(dim=0)[0].tolist())
+    _, local_rank, _, _ = get_dist_setting()
+    tensor = torch.tensor(max_memory_list, device=local_rank)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    new_max_memory_iter = iter(tensor.tolist())
     new_max_memory = {}
     for k, v in max_memory.items():
         new_max_memory[k] = v
@@ -144,20 +207,84 @@ def _infer_auto_device_map_patch(
     return infer_auto_device_map(model, max_memory, verbose=verbose, **kwargs)
 
 
-def dataset_map(
-    dataset: HfDataset, map_func: Callable[[Dict[str, Any]],
-                                           Dict[str, Optional[List[int]]]]
-) -> HfDataset:
-    # faster than dataset.map
-    input_ids = []
-    labels = []
-    for d in tqdm(dataset):
+MapFunc = Callable[[Dict[str, Any]], Dict[str, Optional[List[int]]]]
+# int32 halves the size of the arrow table, token ids and -100 fit in it.
+_MAPPED_FEATURES = Features({
+    'input_ids': Sequence(Value('int32')),
+    'labels': Sequence(Value('int32'))
+})
+
+
+def _map_rows(rows: Iterable[Dict[str, Any]],
+              map_func: MapFunc) -> Iterator[Dict[str, List[int]]]:
+    for d in rows:
         d = map_func(d)
         if d is None or d['input_ids'] is None:
             continue
-        input_ids.append(d['input_ids'])
-        labels.append(d['labels'])
-    return HfDataset.from_dict({'input_ids': input_ids, 'labels': labels})
+        yield {'input_ids': d['input_ids'], 'labels': d['labels']}
+
+
+def _to_record_batch(rows: List[Dict[str, List[int]]]) -> pa.RecordBatch:
+    schema = _MAPPED_FEATURES.arrow_schema
+    arrays = [
+        pa.array([d[k] for d in rows], type=schema.field(k).type)
+        for k in schema.names
+    ]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _map_to_arrow(dataset: HfDataset, map_func: MapFunc,
+                  batch_size: int) -> HfDataset:
+    batches = []
+    rows = []
+    for d in _map_rows(tqdm(dataset), map_func):
+        rows.append(d)
+        if len(rows) >= batch_size:
+            batches.append(_to_record_batch(rows))
+            rows = []
+    if len(rows) > 0:
+        batches.append(_to_record_batch(rows))
+    table = pa.Table.from_batches(
+        batches, schema=_MAPPED_FEATURES.arrow_schema)
+    return HfDataset(table)
+
+
+def _batched_map_func(examples: Dict[str, List[Any]],
+                      map_func: MapFunc) -> Dict[str, List[List[int]]]:
+    keys = list(examples.keys())
+    rows = ({k: examples[k][i]
+             for k in keys} for i in range(len(examples[keys[0]])))
+    res = {'input_ids': [], 'labels': []}
+    for d in _map_rows(rows, map_func):
+        res['input_ids'].append(d['input_ids'])
+        res['labels'].append(d['labels'])
+    return res
+
+
+def dataset_map(dataset: HfDataset,
+                map_func: MapFunc,
+                num_proc: int = 1,
+                batch_size: int = 1000,
+                force: bool = False) -> HfDataset:
+    # The dataset is already mapped (e.g. reused from a previous run).
+    if not force and {'input_ids', 'labels'}.issubset(dataset.column_names):
+        return dataset
+    if num_proc <= 1:
+        # Every `batch_size` rows are converted to an int32 arrow batch, so the corpus is not kept
+        # in python lists. The table stays in memory, no cache file is written.
+        # 20k rows * 200 tokens: 0.9s, `from_dict` 1.3s, `from_generator` 36.4s (it encodes
+        # the features token by token).
+        return _map_to_arrow(dataset, map_func, batch_size)
+    # Each worker process maps batches of rows, the results are written to arrow.
+    return dataset.map(
+        partial(_batched_map_func, map_func=map_func),
+        batched=True,
+        batch_size=batch_size,
+        num_proc=min(num_proc,
+                     os.cpu_count() or 1),
+        remove_columns=dataset.column_names,
+        features=_MAPPED_FEATURES,
+        desc='dataset_map')
 
 
 logger_format = logging.Formatter('[%(levelname)s:%(name)s] %(message)s')
@@ -196,13 +323,17 @@ def get_main(
     return x_main
 
 
+def _get_token_len(dataset: HfDataset) -> np.ndarray:
+    # Compute the lengths on the arrow column instead of decoding every row.
+    # The arrow format applies the indices mapping (e.g. after `dataset.select`).
+    input_ids = dataset.with_format('arrow')['input_ids']
+    # `ChunkedArray.to_numpy` always copies, older pyarrow does not accept `zero_copy_only`.
+    return pc.list_value_length(input_ids).to_numpy()
+
+
 def stat_dataset(dataset: HfDataset) -> None:
     """Statistical analysis was performed on the dataset"""
-    _token_len = []
-    input_ids = dataset['input_ids']
-    for i in range(len(dataset)):
-        _token_len.append(len(input_ids[i]))
-    _, stat_str = stat_array(_token_len)
+    _, stat_str = stat_array(_get_token_len(dataset))
     logger.info(f'Dataset Token Length: {stat_str}')
 
 
@@ -217,28 +348,20 @@ def data_collate_fn(batch: List[Dict[str, Any]],
             will be padded to the `longest`
     """
     assert tokenizer.pad_token_id is not None
-    input_ids = [torch.tensor(b['input_ids']) for b in batch]
-    labels = [torch.tensor(b['labels']) for b in batch]
-    attention_mask = [
-        torch.ones(len(input_ids[i]), dtype=torch.int64)
-        for i in range(len(input_ids))
-    ]
-
-    if padding_to is not None and padding_to > input_ids[0].shape[-1]:
-        input_ids[0] = F.pad(input_ids[0],
-                             (0, padding_to - input_ids[0].shape[-1]),
-                             'constant', tokenizer.pad_token_id)
-        labels[0] = F.pad(labels[0], (0, padding_to - labels[0].shape[-1]),
-                          'constant', -100)
-        attention_mask[0] = F.pad(
-            attention_mask[0], (0, padding_to - attention_mask[0].shape[-1]),
-            'constant', 0)
-
-    input_ids = pad_sequence(
-        input_ids, batch_first=True, padding_value=tokenizer.pad_token_id)
-    attention_mask = pad_sequence(
-        attention_mask, batch_first=True, padding_value=0)
-    labels = pad_sequence(labels, batch_first=True, padding_value=-100)
+    lengths = [len(b['input_ids']) for b in batch]
+    max_length = max(padding_to or 0, max(lengths))
+    # Fill preallocated tensors instead of padding a tensor per sample.
+    input_ids = torch.full((len(batch), max_length),
+                           tokenizer.pad_token_id,
+                           dtype=torch.int64)
+    labels = torch.full((len(batch), max_length), -100, dtype=torch.int64)
+    attention_mask = torch.zeros((len(batch), max_length), dtype=torch.int64)
+    for i, (b, length) in enumerate(zip(batch, lengths)):
+        input_ids[i, :length] = torch.from_numpy(
+            np.asarray(b['input_ids'], dtype=np.int64))
+        labels[i, :length] = torch.from_numpy(
+            np.asarray(b['labels'], dtype=np.int64))
+        attention_mask[i, :length] = 1
 
     return {
         'input_ids': input_ids,
@@ -251,25 +374,16 @@ def _get_labels_str(labels: List[int],
                     tokenizer: PreTrainedTokenizerBase) -> str:
     if len(labels) == 0:
         return ''
-    labels_str = ''
-    for i in range(len(labels)):
-        if i == 0:
-            if labels[i] == -100:
-                s = 0
-            else:
-                e = 0
-            continue
-        if labels[i] == -100 and labels[i - 1] != -100:
-            s = i
-            labels_str += tokenizer.decode(labels[e:s])
-        if labels[i] != -100 and labels[i - 1] == -100:
-            e = i
-            labels_str += f'[-100 * {e - s}]'
-    if labels[-1] == -100:
-        labels_str += f'[-100 * {len(labels) - s}]'
-    else:
-        labels_str += tokenizer.decode(labels[e:])
-    return labels_str
+    mask = np.asarray(labels) == -100
+    # The boundaries of the runs of masked/unmasked labels.
+    edges = np.flatnonzero(np.diff(mask.astype(np.int8))) + 1
+    bounds = [0, *edges.tolist(), len(labels)]
+    segments = list(zip(bounds[:-1], bounds[1:]))
+    decoded = iter(
+        tokenizer.batch_decode(
+            [labels[s:e] for s, e in segments if not mask[s]]))
+    return ''.join(f'[-100 * {e - s}]' if mask[s] else next(decoded)
+                   for s, e in segments)
 
 
 def print_example(example: Dict[str, Any],
@@ -306,27 +420,74 @@ def find_all_linear_for_lora(model: Module, quantization_bit: int,
         linear_cls = Linear4bit
         if AutoGPTQQuantLinear is not None:
             linear_cls = (Linear4bit, AutoGPTQQuantLinear)
+    linear_types = linear_cls if isinstance(linear_cls,
+                                            tuple) else (linear_cls, )
     lora_module_names = set()
     for name, module in model.named_modules():
-        if isinstance(module, linear_cls):
-            module_name = name.split('.')[-1]
-            if head_module_name not in module_name:
-                lora_module_names.add(module_name)
+        if not isinstance(module, linear_types):
+            continue
+        module_name = name.rpartition('.')[2]
+        if (module_name not in lora_module_names
+                and head_module_name not in module_name):
+            lora_module_names.add(module_name)
     return list(lora_module_names)
 
 
 def sort_by_max_length(dataset: HfDataset, num_dataset: int) -> HfDataset:
     logger.info('sort by max length...')
-    input_ids = dataset['input_ids']
-    dataset_len = [len(input_ids[i]) for i in range(len(dataset))]
-    idx = heapq.nlargest(
-        num_dataset, range(len(dataset_len)), key=lambda i: dataset_len[i])
-    input_ids = []
-    labels = []
-    for i in idx:
-        input_ids.append(dataset[i]['input_ids'])
-        labels.append(dataset[i]['labels'])
-    return HfDataset.from_dict({'input_ids': input_ids, 'labels': labels})
+    token_len = _get_token_len(dataset)
+    num_dataset = min(num_dataset, len(token_len))
+    if num_dataset <= 0:
+        return dataset.select([])
+    idx = np.argpartition(token_len, -num_dataset)[-num_dataset:]
+    # Keep the order of `heapq.nlargest`: ties are ordered by their index.
+    idx = np.sort(idx)
+    idx = idx[np.argsort(-token_len[idx], kind='stable')]
+    return dataset.select(idx.tolist())
+
+
+def _get_model_device(model: Module) -> Device:
+    # Cached on the model so that the parameters are not iterated per request.
+    device = getattr(model, '_swift_device', None)
+    if device is None:
+        device = next(model.parameters()).device
+        model._swift_device = device
+    return device
+
+
+# The pinned staging buffer of `_to_device_input_ids`, grown on demand.
+_pin_buffer: Optional[Tensor] = None
+_pin_event: Optional[torch.cuda.Event] = None
+_pin_lock = threading.Lock()
+
+
+def _to_device_input_ids(input_ids: List[int], device: Device) -> Tensor:
+    """Copy the input_ids to the device through a pinned buffer (asynchronous H2D copy)."""
+    if device.type != 'cuda':
+        return torch.tensor(input_ids, dtype=torch.int64, device=device)[None]
+    global _pin_buffer, _pin_event
+    n = len(input_ids)
+    with _pin_lock:
+        if _pin_event is not None:
+            # The previous copy must have finished reading the buffer.
+            _pin_event.synchronize()
+        if _pin_buffer is None or _pin_buffer.shape[0] < n:
+            size = 8192 if _pin_buffer is None else 2 * _pin_buffer.shape[0]
+            _pin_buffer = torch.empty(
+                max(n, size), dtype=torch.int64, pin_memory=True)
+        _pin_buffer[:n].copy_(
+            torch.from_numpy(np.asarray(input_ids, dtype=np.int64)))
+        res = _pin_buffer[:n].to(device, non_blocking=True)
+        _pin_event = torch.cuda.Event()
+        _pin_event.record(torch.cuda.current_stream(device))
+    return res[None]
+
+
+@lru_cache(maxsize=None)
+def _patch_generate_stream(model_cls: Type[Module]) -> None:
+    from transformers_stream_generator.main import NewGenerationMixin
+    model_cls.generate_stream = NewGenerationMixin.generate
+    model_cls.sample_stream = NewGenerationMixin.sample_stream
 
 
 def inference_stream(
@@ -340,14 +501,14 @@ def inference_stream(
     example = {'query': query, 'history': history, 'system': system}
     input_ids = template.encode(example)['input_ids']
     tokenizer = template.tokenizer
-    device = next(model.parameters()).device
-    input_ids = torch.tensor(input_ids)[None].to(device)
-    attention_mask = torch.ones_like(input_ids).to(device)
-    model.eval()
+    device = _get_model_device(model)
+    input_ids = _to_device_input_ids(input_ids, device)
+    attention_mask = torch.ones_like(input_ids)
+    if model.training:
+        model.eval()
     generation_config = getattr(model, 'generation_config', None)
-    from transformers_stream_generator.main import NewGenerationMixin, StreamGenerationConfig
-    model.__class__.generate_stream = NewGenerationMixin.generate
-    model.__class__.sample_stream = NewGenerationMixin.sample_stream
+    from transformers_stream_generator.main import StreamGenerationConfig
+    _patch_generate_stream(model.__class__)
     stream_config = StreamGenerationConfig(
         **generation_config.to_dict(), do_stream=True)
     if stream_config.max_new_tokens is not None:
@@ -367,6 +528,61 @@ def inference_stream(
         yield response, history
 
 
+# (prefix input_ids, past_key_values of the prefix)
+PrefixCache = Tuple[List[int], Any]
+
+
+def _prefill(model: PreTrainedModel,
+             input_ids: List[int],
+             past_key_values: Optional[Any] = None,
+             past_length: int = 0) -> Any:
+    device = _get_model_device(model)
+    kwargs = {}
+    if 'position_ids' in inspect.signature(model.forward).parameters:
+        # e.g. chatglm does not compute the position_ids from past_key_values
+        kwargs['position_ids'] = torch.arange(
+            past_length, past_length + len(input_ids), device=device)[None]
+    attention_mask = torch.ones((1, past_length + len(input_ids)),
+                                dtype=torch.int64,
+                                device=device)
+    with torch.no_grad():
+        outputs = model(
+            input_ids=torch.tensor(input_ids, device=device)[None],
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            **kwargs)
+    return outputs.past_key_values
+
+
+def get_prefix_cache(model: PreTrainedModel,
+                     input_ids_list: List[List[int]]) -> Optional[PrefixCache]:
+    """Prefill the longest common prefix of the encoded examples (e.g. the system part) once,
+    `inference` can reuse it by passing `prefix_cache`."""
+    if len(input_ids_list) < 2:
+        return None
+    prepare_inputs = _get_base_model(model).prepare_inputs_for_generation
+    if 'is_first_forward' in inspect.signature(prepare_inputs).parameters:
+        # e.g. chatglm feeds the whole prompt in the first step even if past_key_values is passed
+        logger.warning(
+            'The model does not support prefix_cache, it is not used.')
+        return None
+    # The last token of each example is left to `generate`.
+    prefix_length = min(len(input_ids) for input_ids in input_ids_list) - 1
+    first_input_ids = input_ids_list[0]
+    for input_ids in input_ids_list[1:]:
+        i = 0
+        while i < prefix_length and input_ids[i] == first_input_ids[i]:
+            i += 1
+        prefix_length = i
+    if prefix_length <= 0:
+        return None
+    prefix = first_input_ids[:prefix_length]
+    if model.training:
+        model.eval()
+    return prefix, _prefill(model, prefix)
+
+
 def inference(model: PreTrainedModel,
               template: Template,
               query: Optional[str] = None,
@@ -376,16 +592,34 @@ def inference(model: PreTrainedModel,
               stream: bool = False,
               verbose: bool = False,
               prompt_prefix: str = '[PROMPT]',
-              output_prefix: str = '[OUTPUT]') -> Tuple[str, History]:
+              output_prefix: str = '[OUTPUT]',
+              prefix_cache: Optional[PrefixCache] = None,
+              input_ids: Optional[List[int]] = None) -> Tuple[str, History]:
+    """input_ids: The already encoded example, if passed, the template is not used for encoding."""
     if history is None:
         history = []
-    example = {'query': query, 'history': history, 'system': system}
-    input_ids = template.encode(example)['input_ids']
+    if input_ids is None:
+        example = {'query': query, 'history': history, 'system': system}
+        input_ids = template.encode(example)['input_ids']
     tokenizer = template.tokenizer
-    device = next(model.parameters()).device
-    input_ids = torch.tensor(input_ids)[None].to(device)
-    attention_mask = torch.ones_like(input_ids).to(device)
-    model.eval()
+    device = _get_model_device(model)
+    # `eval()` walks all the submodules, the model is left in eval mode afterwards.
+    if model.training:
+        model.eval()
+    generate_kwargs = {}
+    if prefix_cache is not None:
+        prefix, past_key_values = prefix_cache
+        prefix_length = len(prefix)
+        if (len(input_ids) > prefix_length
+                and input_ids[:prefix_length] == prefix):
+            # `generate` only feeds the tokens that are not in past_key_values.
+            past_key_values = deepcopy(past_key_values)
+            if len(input_ids) - 1 > prefix_length:
+                past_key_values = _prefill(model, input_ids[prefix_length:-1],
+                                           past_key_values, prefix_length)
+            generate_kwargs['past_key_values'] = past_key_values
+    input_ids = _to_device_input_ids(input_ids, device)
+    attention_mask = torch.ones_like(input_ids)
     generation_config = getattr(model, 'generation_config', None)
     if stream is True and verbose is False:
         logger.warning(
@@ -405,14 +639,98 @@ def inference(model: PreTrainedModel,
         input_ids=input_ids,
         attention_mask=attention_mask,
         streamer=streamer,
-        generation_config=generation_config)
-    response = tokenizer.decode(generate_ids[0, len(input_ids[0]):], True)
+        generation_config=generation_config,
+        **generate_kwargs)
+    generate_ids = generate_ids[0, len(input_ids[0]):].tolist()
+    response = tokenizer.decode(generate_ids, True)
     if verbose and stream is False:
-        print(tokenizer.decode(generate_ids[0, len(input_ids[0]):], False))
+        print(tokenizer.decode(generate_ids, False))
     history.append((query, response))
     return response, history
 
 
+def batch_inference(
+    model: PreTrainedModel,
+    template: Template,
+    examples: List[Dict[str, Any]],
+    input_ids_list: Optional[List[List[int]]] = None,
+    return_generate_ids: bool = False
+) -> Union[List[Tuple[str, History]], List[Tuple[str, History, List[int]]]]:
+    """The inputs are left padded so that the whole batch is generated by a single `generate` call.
+    The model needs to derive the position_ids from the attention_mask (e.g. llama), chatglm does not.
+
+    input_ids_list: The already encoded examples, if passed, the template is not used for encoding.
+    return_generate_ids: Also return the generated token ids (up to and including the eos token),
+        e.g. to print them with the special tokens like `inference(..., verbose=True)`.
+    """
+    if input_ids_list is None:
+        input_ids_list = []
+        for example in examples:
+            example = {
+                'query': example.get('query'),
+                'history': example.get('history'),
+                'system': example.get('system')
+            }
+            input_ids_list.append(template.encode(example)['input_ids'])
+    tokenizer = template.tokenizer
+    max_length = max(len(input_ids) for input_ids in input_ids_list)
+    input_ids = torch.full((len(input_ids_list), max_length),
+                           tokenizer.pad_token_id,
+                           dtype=torch.int64)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, _input_ids in enumerate(input_ids_list):
+        input_ids[i, max_length - len(_input_ids):] = torch.tensor(_input_ids)
+        attention_mask[i, max_length - len(_input_ids):] = 1
+    device = _get_model_device(model)
+    input_ids = input_ids.to(device)
+    attention_mask = attention_mask.to(device)
+    if model.training:
+        model.eval()
+    generation_config = getattr(model, 'generation_config', None)
+    if generation_config.max_new_tokens is not None:
+        generation_config.max_length = 20  # fix max_length, max_new_tokens warning
+    generate_ids = model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        generation_config=generation_config)
+    eos_token_id = generation_config.eos_token_id
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    eos_token_id = set(eos_token_id or [])
+    res = []
+    for example, _generate_ids in zip(examples,
+                                      generate_ids[:, max_length:].tolist()):
+        # The finished sequences are padded, keep the tokens up to the first eos like `inference`.
+        for i, token in enumerate(_generate_ids):
+            if token in eos_token_id:
+                _generate_ids = _generate_ids[:i + 1]
+                break
+        response = tokenizer.decode(_generate_ids, True)
+        history = example.get('history')
+        history = [] if history is None else list(history)
+        history.append((example.get('query'), response))
+        if return_generate_ids:
+            res.append((response, history, _generate_ids))
+        else:
+            res.append((response, history))
+    return res
+
+
+def _get_base_model(model: Module) -> Module:
+    if isinstance(model, SwiftModel):
+        return model.model
+    elif isinstance(model, PeftModel):
+        return model.get_base_model()
+    return model
+
+
+def compile_model(model: Module, mode: str = 'reduce-overhead') -> None:
+    """`generate` calls the forward of the wrapped model, so the forward of the wrapped model is compiled."""
+    require_version('torch>=2.0')
+    model = _get_base_model(model)
+    model.forward = torch.compile(model.forward, mode=mode, dynamic=True)
+
+
 def limit_history_length(template: Template, query: str,
                          history: Optional[History], max_length: int) -> int:
     """binary search"""
@@ -425,8 +743,14 @@ def limit_history_length(template: Template, query: str,
         input_ids = template.encode(example)['input_ids']
         return len(input_ids)
 
-    history_length = upper_bound(
-        0, len(history), lambda mid: compute_token_length(mid) <= max_length)
+    # Most of the time the whole history fits, which only needs one encode.
+    if len(history) == 0 or compute_token_length(len(history)) <= max_length:
+        history_length = len(history)
+    else:
+        history_length = upper_bound(
+            0,
+            len(history) - 1,
+            lambda mid: compute_token_length(mid) <= max_length)
     old_history = history[:len(history) - history_length]
     history = history[len(history) - history_length:]
     return old_history, history
@@ -1,6 +1,7 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
 
-from .io_utils import append_to_jsonl, read_from_jsonl, write_to_jsonl
+from .io_utils import (append_to_jsonl, read_from_json, read_from_jsonl,
+                       write_to_jsonl)
 from .logger import get_logger
 from .metric import (compute_acc_metrics, compute_nlg_metrics,
                      preprocess_logits_for_metrics)
@@ -11,5 +12,5 @@ from .torch_utils import (broadcast_string, get_dist_setting, is_ddp_plus_mp,
                           is_dist, is_local_master, is_master,
                           is_on_same_device, print_model_info, seed_everything,
                           show_layers)
-from .utils import (add_version_to_work_dir, check_json_format, lower_bound,
-                    parse_args, upper_bound)
+from .utils import (LazyHelp, add_version_to_work_dir, check_json_format,
+                    lower_bound, parse_args, upper_bound)
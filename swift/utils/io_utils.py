@@ -3,6 +3,25 @@ from typing import Any, List
 
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def read_from_json(fpath: str, encoding: str = 'utf-8') -> Any:
+    """Use `orjson` if it is installed, which is faster than `json` for large files."""
+    if orjson is None:
+        with open(fpath, 'r', encoding=encoding) as f:
+            return json.load(f)
+    with open(fpath, 'rb') as f:
+        data = f.read()
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # e.g. `NaN`/`Infinity`, which `json.dump` writes by default but `orjson` rejects.
+        return json.loads(data.decode(encoding))
+
 
 def read_from_jsonl(fpath: str, encoding: str = 'utf-8') -> List[Any]:
     res: List[Any] = []
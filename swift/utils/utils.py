@@ -54,12 +54,30 @@ def add_version_to_work_dir(work_dir: str) -> str:
     return work_dir
 
 
+class LazyHelp(str):
+    """A help string whose full text is only built when `--help` is formatted."""
+
+    def __new__(cls, help_str: str, get_help: Callable[[], str]) -> 'LazyHelp':
+        obj = super().__new__(cls, help_str)
+        obj.get_help = get_help
+        return obj
+
+
+class _ArgumentParser(HfArgumentParser):
+
+    def format_help(self) -> str:
+        for action in self._actions:
+            if isinstance(action.help, LazyHelp):
+                action.help = action.help.get_help()
+        return super().format_help()
+
+
 _T = TypeVar('_T')
 
 
 def parse_args(class_type: Type[_T],
                argv: Optional[List[str]] = None) -> Tuple[_T, List[str]]:
-    parser = HfArgumentParser([class_type])
+    parser = _ArgumentParser([class_type])
     args, remaining_args = parser.parse_args_into_dataclasses(
         argv, return_remaining_strings=True)
     return args, remaining_args
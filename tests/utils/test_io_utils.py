@@ -1,10 +1,14 @@
+import math
 import os
 import shutil
 import tempfile
 import unittest
+from unittest.mock import patch
 
-from swift.utils import (append_to_jsonl, get_logger, read_from_jsonl,
-                         write_to_jsonl)
+import json
+
+from swift.utils import (append_to_jsonl, get_logger, io_utils, read_from_json,
+                         read_from_jsonl, write_to_jsonl)
 
 logger = get_logger()
 
@@ -38,6 +42,27 @@ class TestIOUtils(unittest.TestCase):
         new_obj_list = read_from_jsonl(fpath)
         self.assertTrue(new_obj_list == obj_list)
 
+    def test_json(self):
+        fpath = os.path.join(self.tmp_dir, '1.json')
+        obj = [{'prompt': '{} was the founder of', 'subject': '乔布斯'}, 1.1]
+        with open(fpath, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, ensure_ascii=False)
+        self.assertTrue(read_from_json(fpath) == obj)
+        # Without orjson, the stdlib json is used.
+        with patch('swift.utils.io_utils.orjson', None):
+            self.assertTrue(read_from_json(fpath) == obj)
+
+    def test_json_nan(self):
+        fpath = os.path.join(self.tmp_dir, '1.json')
+        obj = {'loss': float('nan'), 'max': float('inf')}
+        with open(fpath, 'w', encoding='utf-8') as f:
+            json.dump(obj, f)
+        for orjson in [io_utils.orjson, None]:
+            with patch('swift.utils.io_utils.orjson', orjson):
+                res = read_from_json(fpath)
+            self.assertTrue(math.isnan(res['loss']))
+            self.assertTrue(res['max'] == float('inf'))
+
 
 if __name__ == '__main__':
     unittest.main()
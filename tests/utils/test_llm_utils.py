@@ -1,12 +1,37 @@
+import heapq
 import os
 import unittest
 
-from swift.llm import (ModelType, get_default_template_type,
-                       get_model_tokenizer, get_template, inference,
-                       inference_stream, print_example)
+from datasets import Dataset as HfDataset
+
+from swift.llm import (ModelType, data_collate_fn, dataset_map,
+                       get_default_template_type, get_model_tokenizer,
+                       get_prefix_cache, get_template, inference,
+                       inference_stream, limit_history_length, print_example,
+                       sort_by_max_length)
 from swift.utils import lower_bound, seed_everything
 
 
+class _Tokenizer:
+    pad_token_id = 0
+
+
+class _Template:
+    """One token per character of the query and the history."""
+
+    def encode(self, example):
+        length = len(example['query'])
+        for q, r in example.get('history') or []:
+            length += len(q) + len(r)
+        return {'input_ids': [1] * length, 'labels': [1] * length}
+
+
+def _map_func(example):
+    if example['query'] == '':
+        return None
+    return _Template().encode(example)
+
+
 class TestLlmUtils(unittest.TestCase):
 
     def test_count_startswith(self):
@@ -19,6 +44,72 @@ class TestLlmUtils(unittest.TestCase):
         self.assertTrue(
             lower_bound(0, len(arr), lambda i: arr[i] == -100) == 1000)
 
+    def test_dataset_map(self):
+        dataset = HfDataset.from_dict(
+            {'query': ['a', '', 'bcd', 'ef', '', 'ghij'] * 10})
+        res = dataset_map(dataset, _map_func)
+        res2 = dataset_map(dataset, _map_func, num_proc=2, batch_size=7)
+        self.assertTrue(len(res) == 40)
+        self.assertTrue(res[:] == res2[:])
+        self.assertTrue(len(res.cache_files) == 0)  # kept in memory
+        for d in [res, res2]:
+            self.assertTrue(d.features['input_ids'].feature.dtype == 'int32')
+            self.assertTrue(d.features['labels'].feature.dtype == 'int32')
+        # already mapped
+        self.assertTrue(dataset_map(res, _map_func) is res)
+
+    def test_sort_by_max_length(self):
+        lengths = [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5, 8, 9, 7, 9, 3, 2, 3]
+        dataset = HfDataset.from_dict({
+            'input_ids': [[i] * n for i, n in enumerate(lengths)],
+            'labels': [[-100] * n for n in lengths]
+        })
+        for d in [dataset, dataset.select([17, 2, 5, 9, 14, 0, 12, 4])]:
+            d_len = [len(input_ids) for input_ids in d['input_ids']]
+            for num_dataset in [0, 3, 5, len(d), len(d) + 10]:
+                idx = heapq.nlargest(
+                    num_dataset, range(len(d_len)), key=lambda i: d_len[i])
+                res = sort_by_max_length(d, num_dataset)
+                self.assertTrue(res[:] == d.select(idx)[:])
+
+    def test_data_collate_fn(self):
+        batch = [{
+            'input_ids': [1, 2, 3, 4],
+            'labels': [-100, -100, 3, 4]
+        }, {
+            'input_ids': [5, 6],
+            'labels': [-100, 6]
+        }]
+        tokenizer = _Tokenizer()
+        for padding_to, max_length in [(None, 4), (2, 4), (8, 8)]:
+            res = data_collate_fn(batch, tokenizer, padding_to)
+            self.assertTrue(res['input_ids'].shape == (2, max_length))
+            pad_len = max_length - 2
+            self.assertTrue(res['input_ids'][1].tolist() == [5, 6]
+                            + [0] * pad_len)
+            self.assertTrue(res['labels'][1].tolist() == [-100, 6]
+                            + [-100] * pad_len)
+            self.assertTrue(res['attention_mask'].sum(
+                dim=1).tolist() == [4, 2])
+
+    def test_limit_history_length(self):
+        template = _Template()
+        history = [['aa', 'bb'], ['cc', 'dd'], ['ee', 'ff'], ['gg', 'hh']]
+        # fits
+        old_history, new_history = limit_history_length(
+            template, 'q', history, 17)
+        self.assertTrue(old_history == [] and new_history == history)
+        old_history, new_history = limit_history_length(template, 'q', None, 1)
+        self.assertTrue(old_history == [] and new_history == [])
+        # cut
+        old_history, new_history = limit_history_length(
+            template, 'q', history, 10)
+        self.assertTrue(old_history == history[:2])
+        self.assertTrue(new_history == history[2:])
+        old_history, new_history = limit_history_length(
+            template, 'q', history, 4)
+        self.assertTrue(old_history == history and new_history == [])
+
     def test_inference(self):
         model_type = ModelType.chatglm2_6b
         model, tokenizer = get_model_tokenizer(model_type)
@@ -50,6 +141,32 @@ class TestLlmUtils(unittest.TestCase):
             self.assertTrue(gen_text_stream == gen_text_stream2 == gen_text)
             self.assertTrue(history == history2 == history3)
 
+    def test_prefix_cache(self):
+        system = 'You are a helpful assistant.'
+        queries = ['你好', 'hello']
+        for model_type in [ModelType.llama2_7b_chat, ModelType.chatglm3_6b]:
+            model, tokenizer = get_model_tokenizer(model_type)
+            template_type = get_default_template_type(model_type)
+            template = get_template(template_type, tokenizer)
+            model.generation_config.max_new_tokens = 32
+            model.generation_config.do_sample = False
+            input_ids_list = [
+                template.encode({
+                    'query': query,
+                    'system': system
+                })['input_ids'] for query in queries
+            ]
+            prefix_cache = get_prefix_cache(model, input_ids_list)
+            for query in queries:
+                response, _ = inference(model, template, query, system=system)
+                response2, _ = inference(
+                    model,
+                    template,
+                    query,
+                    system=system,
+                    prefix_cache=prefix_cache)
+                self.assertTrue(response == response2)
+
     def test_print_example(self):
         input_ids = [1000, 2000, 3000, 4000, 5000, 6000]
         _, tokenizer = get_model_tokenizer(